@@ -0,0 +1,198 @@
+import asyncio
+import typing as t
+import logging
+
+try:
+    import redis.asyncio as aioredis
+    # redis is unreachable, commands keep failing until it is back
+    OUTAGE_ERRORS: tuple[type[Exception], ...] = (aioredis.ConnectionError, aioredis.TimeoutError)
+except ImportError:  # optional, installed with the `backplane` extra
+    aioredis = None
+    OUTAGE_ERRORS = ()
+
+
+logger = logging.getLogger(__name__)
+
+# notification that the shared roster has changed
+USERLIST_CHANNEL = "signaling:userlist"
+# per-user channel, subscribed by the worker holding that user's socket
+USER_CHANNEL_PREFIX = "signaling:user:"
+# hash of username -> status shared by all workers
+ROSTER_KEY = "signaling:users"
+# seconds between attempts to resubscribe after losing the redis connection
+RECONNECT_DELAY = 1.0
+
+MessageHandler = t.Callable[[str, str], None]
+
+
+class RedisBackplane:
+    """
+    Redis pub/sub layer letting several server processes share users,
+    the userlist and direct messages
+
+    Connection errors don't leave this class: while redis is down the
+    commands are logged and skipped, so callers fall back to local users
+    """
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise RuntimeError("redis is required for the backplane, install the `backplane` extra")
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.pubsub = self.redis.pubsub()
+        # channels to restore when the subscription has to be rebuilt
+        self._channels: set[str] = {USERLIST_CHANNEL}
+        # held while the subscription is rebuilt, so (un)subscribes wait for the new one
+        self._pubsub_lock = asyncio.Lock()
+        # released users whose roster entry couldn't be removed yet
+        self._unreleased: set[str] = set()
+        self._listener: asyncio.Task | None = None
+
+    async def start(self, handler: MessageHandler):
+        await self.pubsub.subscribe(*self._channels)
+        self._listener = asyncio.create_task(self._sub_loop(handler))
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        await self.pubsub.close()
+        await self.redis.close()
+
+    async def _sub_loop(self, handler: MessageHandler):
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    try:
+                        handler(message['channel'], message['data'])
+                    except Exception:
+                        logger.exception('backplane message handling failed')
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('backplane subscription lost, reconnecting')
+            await self._resubscribe()
+            # roster changes published while we were away are lost
+            handler(USERLIST_CHANNEL, '')
+
+    async def _resubscribe(self):
+        while True:
+            await asyncio.sleep(RECONNECT_DELAY)
+            async with self._pubsub_lock:
+                try:
+                    await self.pubsub.reset()
+                except Exception:
+                    pass
+                try:
+                    self.pubsub = self.redis.pubsub()
+                    await self.pubsub.subscribe(*self._channels)
+                    logger.info('backplane resubscribed to %d channels', len(self._channels))
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('backplane resubscribe failed, retrying')
+        await self._drop_unreleased(*self._unreleased)
+
+    def _outage(self, action: str, username: str):
+        logger.warning('backplane unavailable, %s %s skipped', action, username)
+
+    ###############
+    # messaging
+    ###############
+
+    async def publish_user(self, username: str, envelope: str):
+        try:
+            await self.redis.publish(USER_CHANNEL_PREFIX + username, envelope)
+        except OUTAGE_ERRORS:
+            self._outage('message to', username)
+
+    async def subscribe_user(self, username: str):
+        # the channel is subscribed again on reconnect if this fails
+        self._channels.add(USER_CHANNEL_PREFIX + username)
+        try:
+            async with self._pubsub_lock:
+                await self.pubsub.subscribe(USER_CHANNEL_PREFIX + username)
+        except OUTAGE_ERRORS:
+            self._outage('subscribe of', username)
+
+    ###############
+    # roster
+    ###############
+
+    async def claim(self, username: str) -> bool:
+        # False when another worker already has this username, or redis is down
+        if username in self._unreleased:
+            await self._drop_unreleased(username)
+        try:
+            return bool(await self.redis.hsetnx(ROSTER_KEY, username, 'offline'))
+        except OUTAGE_ERRORS:
+            self._outage('claim of', username)
+            return False
+
+    async def set_status(self, username: str, status: str):
+        try:
+            await self._set_status(username, status)
+        except OUTAGE_ERRORS:
+            self._outage('status update of', username)
+
+    async def _set_status(self, username: str, status: str):
+        # only update users still on the roster, a plain HSET would bring back
+        # a user released in the meantime and block the name for good
+        async with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(ROSTER_KEY)
+                    if not await pipe.hexists(ROSTER_KEY, username):
+                        return
+                    pipe.multi()
+                    pipe.hset(ROSTER_KEY, username, status)
+                    await pipe.execute()
+                    break
+                except aioredis.WatchError:
+                    # roster changed between the check and the write
+                    continue
+        await self.redis.publish(USERLIST_CHANNEL, username)
+
+    async def get_status(self, username: str) -> str | None:
+        # None for unknown users, as well as while redis is down
+        try:
+            return await self.redis.hget(ROSTER_KEY, username)
+        except OUTAGE_ERRORS:
+            self._outage('status lookup of', username)
+            return None
+
+    async def release(self, username: str):
+        self._channels.discard(USER_CHANNEL_PREFIX + username)
+        try:
+            async with self._pubsub_lock:
+                await self.pubsub.unsubscribe(USER_CHANNEL_PREFIX + username)
+        except OUTAGE_ERRORS:
+            # a rebuilt subscription won't include the channel anyway
+            pass
+        self._unreleased.add(username)
+        await self._drop_unreleased(username)
+
+    async def _drop_unreleased(self, *usernames: str):
+        # roster entries left behind by releases that failed during an outage
+        dropped = []
+        for username in usernames:
+            try:
+                await self.redis.hdel(ROSTER_KEY, username)
+            except OUTAGE_ERRORS:
+                self._outage('release of', username)
+                break
+            self._unreleased.discard(username)
+            dropped.append(username)
+        for username in dropped:
+            try:
+                await self.redis.publish(USERLIST_CHANNEL, username)
+            except OUTAGE_ERRORS:
+                break
+
+    async def roster(self) -> dict[str, str] | None:
+        # None while redis is down
+        try:
+            return await self.redis.hgetall(ROSTER_KEY)
+        except OUTAGE_ERRORS:
+            logger.warning('backplane unavailable, roster lookup skipped')
+            return None
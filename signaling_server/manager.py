@@ -0,0 +1,450 @@
+import asyncio
+import functools
+import typing as t
+import logging
+
+import orjson
+
+from starlette.types import Receive, Scope, Send
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from signaling_server.backplane import (
+    USERLIST_CHANNEL, USER_CHANNEL_PREFIX, RedisBackplane
+)
+
+
+logger = logging.getLogger(__name__)
+
+JSONType = t.Union[str, int, float, bool, None, t.Dict[str, t.Any], t.List[t.Any]] 
+
+# seconds to coalesce userlist changes into a single broadcast
+USERLIST_FLUSH_INTERVAL = 0.05
+# pending outbound frames per client before it is considered too slow
+OUTBOUND_QUEUE_SIZE = 64
+
+# constant server messages, serialized once at import
+LOGIN_OK_FRAME = orjson.dumps({ "type": "server_login", "success": True }).decode()
+LOGIN_FAILED_FRAME = orjson.dumps({ "type": "server_login", "success": False }).decode()
+NOUSER_FRAME = orjson.dumps({ "type": "server_nouser", "success": False }).decode()
+BUSY_FRAME = orjson.dumps({ "type": "server_busyuser" }).decode()
+LEAVE_FRAME = orjson.dumps({ "type": "server_userwanttoleave" }).decode()
+PONG_FRAME = orjson.dumps({ "type": "server_pong", "name": "pong" }).decode()
+MALFORMED_FRAME = orjson.dumps({ "type": "server_error", "message": "Malformed message" }).decode()
+
+# reused message templates for the candidate/answer relay; orjson serializes
+# synchronously, so filling them in right before dumps() is safe
+_CANDIDATE_TMPL: dict[str, t.Any] = { "type": "server_candidate", "candidate": None }
+_ANSWER_TMPL: dict[str, t.Any] = { "type": "server_answer", "answer": None }
+
+
+class UserEntry:
+    """
+    Logged in user: its connection and status kept side by side
+    """
+    __slots__ = ('ws', 'status')
+
+    def __init__(self, ws: 'SignalingWebSocket', status: str = 'offline'):
+        self.ws = ws
+        self.status = status
+
+
+class SignalingWebSocket(WebSocket):
+    """
+    WebSocket carrying the per-connection state used by the manager
+    """
+    # slots instead of growing the instance __dict__ for every connection
+    __slots__ = (
+        'name', 'otherName', 'is_open', 'peer_ws',
+        'out_queue', 'writer_task', 'asgi_receive', 'asgi_send',
+    )
+    name: str | None
+    otherName: str | None
+    is_open: bool
+    # socket of the room peer, set once both sides are ready
+    peer_ws: t.Optional['SignalingWebSocket']
+    out_queue: 'asyncio.Queue[str]'
+    writer_task: t.Optional['asyncio.Task[None]']
+    asgi_receive: Receive
+    asgi_send: Send
+
+    def __init__(self, scope: Scope, receive: Receive, send: Send):
+        super().__init__(scope, receive=receive, send=send)
+        self.name = None
+        self.otherName = None
+        self.is_open = False
+        self.peer_ws = None
+        self.writer_task = None
+
+
+class ConnectionManager:
+    """
+    Idea is to hide choosen protocol behind this manager
+    """
+    def __init__(self, backplane: RedisBackplane | None = None):
+        self.users: dict[str, UserEntry] = {}
+        # shares users between server processes, None when running standalone
+        self.backplane = backplane
+        self._background_tasks: set[asyncio.Task] = set()
+        # shared roster cleanup still running per username, see _wait_release
+        self._pending_releases: dict[str, asyncio.Task] = {}
+        self._userlist_dirty = asyncio.Event()
+        self._userlist_flusher_task: asyncio.Task | None = None
+        # serialized server_userlist frame, reset whenever the roster changes
+        self._userlist_cache: str | None = None
+
+    async def connect(self, connection: SignalingWebSocket, receive: Receive | None = None, send: Send | None = None):
+        await connection.accept()
+        # once accepted, frames go straight through the ASGI callables when
+        # given, skipping Starlette's per-call state checks
+        connection.asgi_receive = receive or connection.receive
+        connection.asgi_send = send or connection.send
+        # plain attribute, cheaper than client_state on every send
+        connection.is_open = True
+        # every outbound message goes through the queue, drained by a dedicated writer
+        connection.out_queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        connection.writer_task = asyncio.create_task(self._writer(connection))
+        if self._userlist_flusher_task is None or self._userlist_flusher_task.done():
+            self._userlist_flusher_task = asyncio.create_task(self._userlist_flusher())
+    
+    def register_user_connection(self, username: str, connection: SignalingWebSocket):
+        self.users[username] = UserEntry(connection)
+        self._userlist_cache = None
+        # store the connection details 
+        connection.name = username
+        connection.otherName = None
+    
+    async def update_user_status(self, username: str, status: str='offline'):
+        # store the connection name in the userlist 
+        entry = self.users.get(username)
+        if entry is not None:
+            entry.status = status
+            self._userlist_cache = None
+        if self.backplane is not None:
+            await self.backplane.set_status(username, status)
+    
+    async def get_user_status(self, username: str) -> str | None: 
+        entry = self.users.get(username)
+        if entry is not None:
+            return entry.status
+        return await self._remote_status(username)
+
+    async def _remote_status(self, username: str) -> str | None:
+        # status of a user connected to another server process
+        if self.backplane is None:
+            return None
+        return await self.backplane.get_status(username)
+
+    def get_connection(self, username: str) -> SignalingWebSocket | None:
+        entry = self.users.get(username)
+        return entry.ws if entry is not None else None
+
+    def _unregister_user(self, connection: SignalingWebSocket):
+        # registries are keyed by username, not by the socket itself
+        name = connection.name
+        self._unlink_peer(connection)
+        if name and self.get_connection(name) is connection:
+            del self.users[name]
+            self._userlist_cache = None
+            self.update_users_list()
+            if self.backplane is not None:
+                task = self._spawn(self.backplane.release(name))
+                self._pending_releases[name] = task
+                task.add_done_callback(functools.partial(self._release_done, name))
+
+    def _release_done(self, username: str, task: asyncio.Task):
+        # a newer release for the same name may have replaced this one
+        if self._pending_releases.get(username) is task:
+            del self._pending_releases[username]
+
+    async def _wait_release(self, username: str):
+        # the shared roster must drop the old entry before the name can be claimed again
+        task = self._pending_releases.get(username)
+        if task is not None:
+            await asyncio.wait([task])
+
+    def _spawn(self, coro: t.Coroutine) -> asyncio.Task:
+        # keep a reference so the task isn't garbage collected mid-flight
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def _unlink_peer(self, connection: SignalingWebSocket):
+        peer = connection.peer_ws
+        if peer is not None and peer.peer_ws is connection:
+            peer.peer_ws = None
+        connection.peer_ws = None
+
+    def disconnect(self, connection: SignalingWebSocket):
+        connection.is_open = False
+        self._unregister_user(connection)
+        if connection.writer_task is not None:
+            connection.writer_task.cancel()
+
+    async def _writer(self, connection: SignalingWebSocket):
+        queue = connection.out_queue
+        send = connection.asgi_send
+        try:
+            while True:
+                payload = await queue.get()
+                await send({'type': 'websocket.send', 'text': payload})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # receiving side notices the closed socket and cleans up
+            connection.is_open = False
+            logger.warning("writer for %s stopped: %r", connection.name, e)
+
+    def _drop_slow_connection(self, connection: SignalingWebSocket):
+        logger.warning("outbound queue of %s is full, closing", connection.name)
+        self.disconnect(connection)
+        self._spawn(self._close(connection))
+
+    async def _close(self, connection: SignalingWebSocket):
+        try:
+            await connection.close(code=1008)
+        except Exception:
+            pass
+
+    async def receive_message(self, connection: SignalingWebSocket) -> dict | None:
+        # parse the raw frame with orjson instead of receive_json's text round-trip;
+        # None when the frame isn't a JSON object and was answered with server_error
+        message = await connection.asgi_receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000))
+        raw = message.get('text')
+        if raw is None:
+            raw = message.get('bytes')
+        try:
+            data = orjson.loads(raw) if raw else None
+        except orjson.JSONDecodeError:
+            data = None
+        if not isinstance(data, dict):
+            self._enqueue(connection, MALFORMED_FRAME)
+            return None
+        return data
+
+    async def send_message(self, connection: SignalingWebSocket,  message: dict):
+        # client expects text frames; orjson is much faster than send_json's json.dumps
+        await self.send_raw(connection, orjson.dumps(message).decode())
+
+    async def send_raw(self, connection: SignalingWebSocket, frame: str):
+        # frame is an already serialized message, see *_FRAME constants
+        self._enqueue(connection, frame)
+
+    def _enqueue(self, connection: SignalingWebSocket, frame: str):
+        if connection.is_open:
+            try:
+                connection.out_queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._drop_slow_connection(connection)
+
+    async def broadcast(self, message: JSONType):
+        # serialize once, then hand the same frame to every peer
+        self.broadcast_text(orjson.dumps(message).decode())
+
+    def broadcast_text(self, payload: str):
+        # no awaiting here: each writer drains its own queue, a client that
+        # can't keep up overflows it and gets dropped instead of stalling us
+        for entry in list(self.users.values()):
+            self._enqueue(entry.ws, payload)
+
+    async def _send_to_user(self, username: str, conn: SignalingWebSocket | None, frame: str, **remote_opts):
+        # conn is the local socket of username, None if it lives in another process
+        if conn is not None:
+            self._enqueue(conn, frame)
+        elif self.backplane is not None:
+            remote_opts['frame'] = frame
+            await self.backplane.publish_user(username, orjson.dumps(remote_opts).decode())
+
+    def _on_backplane_message(self, channel: str, data: str):
+        if channel == USERLIST_CHANNEL:
+            self.update_users_list()
+        else:
+            conn = self.get_connection(channel[len(USER_CHANNEL_PREFIX):])
+            if conn is None:
+                return
+            envelope = orjson.loads(data)
+            # candidates are only relayed to users who are in a room
+            if envelope.get('in_room') and conn.otherName == None:
+                return
+            # room peer living in another process
+            if 'other' in envelope:
+                conn.otherName = envelope['other']
+                self._unlink_peer(conn)
+            self._enqueue(conn, envelope['frame'])
+
+    ###############
+    # service layer
+    ###############
+
+    def update_users_list(self):
+        # changes are coalesced and sent by _userlist_flusher
+        self._userlist_dirty.set()
+
+    async def _userlist_flusher(self):
+        while True:
+            await self._userlist_dirty.wait()
+            # let a burst of changes accumulate before broadcasting
+            await asyncio.sleep(USERLIST_FLUSH_INTERVAL)
+            self._userlist_dirty.clear()
+            try:
+                await self._broadcast_userlist()
+            except Exception:
+                logger.exception('userlist broadcast failed')
+
+    async def _broadcast_userlist(self):
+        if self.backplane is not None:
+            # shared roster changes in other processes too, so it isn't cached
+            roster = await self.backplane.roster()
+            # None while redis is down, the local users are sent instead
+            if roster is not None:
+                self.broadcast_text(orjson.dumps({ 'type': "server_userlist", 'name': list(roster.items())}).decode())
+                return
+        if self._userlist_cache is None:
+            self._userlist_cache = orjson.dumps({ 'type': "server_userlist", 'name': [(u, e.status) for u, e in self.users.items()]}).decode()
+        self.broadcast_text(self._userlist_cache)
+    
+    async def login_user(self, username: str, connection: SignalingWebSocket):
+        if username not in self.users:
+            await self._wait_release(username)
+        if  username in self.users or (
+            self.backplane is not None and not await self.backplane.claim(username)
+        ):
+            # Already same username has logged in the server 
+            # send response to client back with login failed 
+            await self.send_raw(connection, LOGIN_FAILED_FRAME)
+            logger.info("login failed")
+        else:
+            # store the connection details 
+            self.register_user_connection(username, connection)
+            if self.backplane is not None:
+                await self.backplane.subscribe_user(username)
+            await self.update_user_status(username, 'online')
+            # notify user about successful login
+            await self.send_raw(connection, LOGIN_OK_FRAME)
+            logger.info("Login sucess")
+            self.update_users_list()
+
+    async def send_offer(self, username: str, offer: dict, connection: SignalingWebSocket):
+        # Check the peer user has logged in the server 
+        conn = self.get_connection(username)
+        if conn:
+            exists, available = True, conn.otherName == None
+        else:
+            status = await self._remote_status(username)
+            exists, available = status is not None, status != 'busy'
+
+        if not exists:
+            # Error handling 
+            logger.info("connection is None..")
+            await self.send_raw(connection, NOUSER_FRAME)
+
+        elif available:
+            # When user is free and availble for the offer 
+            # Send the offer to peer user 
+            frame = orjson.dumps({ 'type': "server_offer", 'offer': offer, 'name': connection.name }).decode()
+            await self._send_to_user(username, conn, frame)
+
+        else:
+            # User has in the room, User is can't accept the offer 
+            await self.send_message(connection, { "type": "server_alreadyinroom", "success": True, "name": username})
+    
+    async def send_answer(self, username: str, answer: dict):
+        conn = self.get_connection(username)
+        if conn or self.backplane is not None:
+            _ANSWER_TMPL["answer"] = answer
+            frame = orjson.dumps(_ANSWER_TMPL).decode()
+            _ANSWER_TMPL["answer"] = None
+            await self._send_to_user(username, conn, frame)
+    
+    async def send_candidate_request(self, username: str, candidate: dict, connection: SignalingWebSocket):
+        # fast path: peer socket is linked directly once the room is set up
+        conn = connection.peer_ws
+        if conn is None:
+            conn = self.get_connection(username)
+            if conn is None and self.backplane is None:
+                return
+            if conn is not None and conn.otherName == None:
+                return
+        _CANDIDATE_TMPL["candidate"] = candidate
+        frame = orjson.dumps(_CANDIDATE_TMPL).decode()
+        _CANDIDATE_TMPL["candidate"] = None
+        await self._send_to_user(username, conn, frame, in_room=True)
+        logger.debug("candidate sending --")
+
+    async def leave(self, username: str, connection: SignalingWebSocket):
+        if connection.name is None:
+            # only logged in users can be in a room; before this check the
+            # request failed on the missing name attribute
+            return
+        conn = self.get_connection(username)
+        if conn or await self._remote_status(username):
+            # Send response back to users who are in the room 
+            await self._send_to_user(username, conn, LEAVE_FRAME, other=None)
+            await self.send_raw(connection, LEAVE_FRAME)
+            await self.update_user_status(username, 'online')
+            await self.update_user_status(connection.name, 'online')
+
+            # Update the connection status with available 
+            if conn:
+                conn.otherName = None
+                self._unlink_peer(conn)
+            connection.otherName = None
+            self._unlink_peer(connection)
+
+            self.update_users_list()
+            logger.info("end room")
+    
+    async def busy(self, username: str):
+        conn = self.get_connection(username)
+        await self._send_to_user(username, conn, BUSY_FRAME)
+    
+    async def want_to_call(self, username: str, connection: SignalingWebSocket):
+        conn = self.get_connection(username)
+        status = await self.get_user_status(username)
+        if status is not None:
+            # otherName of a user in another process is only known there
+            if status == 'busy' and (conn is None or conn.otherName != None):
+                # User has in the room, User can't accept the offer 
+                await self.send_message(connection, { "type": "server_alreadyinroom", "success": True, "name": username })
+            else:
+                # User is avilable, User can accept the offer 
+                await self.send_message(connection, { "type": "server_alreadyinroom", "success": False, "name": username })
+        else:
+            # Error handling with invalid query 
+            await self.send_raw(connection, NOUSER_FRAME)
+    
+    async def handle_ready(self, username: str, connection: SignalingWebSocket):
+        if connection.name is None:
+            # only logged in users can be in a room; before this check the
+            # request failed on the missing name attribute
+            return
+        conn = self.get_connection(username)
+        if conn or await self._remote_status(username):
+            # Update the user status with peer name
+            connection.otherName = username
+            if conn:
+                conn.otherName = connection.name
+                connection.peer_ws = conn
+                conn.peer_ws = connection
+            await self.update_user_status(username,'busy')
+            await self.update_user_status(connection.name,'busy')
+
+            # Send response to each users 
+            frame = orjson.dumps({ "type": "server_userready", "success": True, "peername": connection.name }).decode()
+            await self._send_to_user(username, conn, frame, other=connection.name)
+            await self.send_message(connection, { "type": "server_userready", "success": True, "peername": username })
+            # Send updated user list to all existing users 
+            self.update_users_list()
+    
+    async def handle_quit(self, username: str, connection: SignalingWebSocket):
+        # socket stays open so the writer is kept, user may log in again;
+        # updated user list is sent to all existing users
+        name = connection.name
+        self._unregister_user(connection)
+        # the socket no longer acts as that user, nor as a room member
+        connection.name = None
+        connection.otherName = None
+        if name is not None:
+            await self._wait_release(name)
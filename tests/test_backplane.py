@@ -0,0 +1,147 @@
+import asyncio
+
+import orjson
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from signaling_server import backplane
+from signaling_server.manager import ConnectionManager, SignalingWebSocket
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    # every RedisBackplane in a test talks to the same in-memory server
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        backplane.aioredis, 'from_url',
+        lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs),
+    )
+    return server
+
+
+async def start_worker() -> ConnectionManager:
+    manager = ConnectionManager(backplane.RedisBackplane('redis://fake'))
+    await manager.backplane.start(manager._on_backplane_message)
+    return manager
+
+
+async def open_connection(manager: ConnectionManager):
+    received = []
+
+    async def receive():
+        return {'type': 'websocket.connect'}
+
+    async def send(message):
+        if message['type'] == 'websocket.send':
+            received.append(orjson.loads(message['text']))
+
+    connection = SignalingWebSocket({'type': 'websocket', 'path': '/ws', 'headers': []}, receive, send)
+    await manager.connect(connection, receive, send)
+    return connection, received
+
+
+async def received_type(received, a_type, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        for message in received:
+            if message['type'] == a_type:
+                return message
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"{a_type} not received")
+
+
+def test_quit_then_login_with_same_name(redis_server):
+    async def scenario():
+        manager = await start_worker()
+        connection, received = await open_connection(manager)
+
+        await manager.login_user('alice', connection)
+        await manager.handle_quit('alice', connection)
+        received.clear()
+        await manager.login_user('alice', connection)
+
+        assert (await received_type(received, 'server_login'))['success'] is True
+        assert await manager.backplane.roster() == {'alice': 'online'}
+        await manager.backplane.close()
+
+    asyncio.run(scenario())
+
+
+def test_room_setup_across_workers(redis_server):
+    async def scenario():
+        first, second = await start_worker(), await start_worker()
+        alice, alice_received = await open_connection(first)
+        bob, bob_received = await open_connection(second)
+        await first.login_user('alice', alice)
+        await second.login_user('bob', bob)
+
+        userlist = await received_type(alice_received, 'server_userlist')
+        assert sorted(map(tuple, userlist['name'])) == [('alice', 'online'), ('bob', 'online')]
+
+        await first.send_offer('bob', {'sdp': 'offer'}, alice)
+        assert (await received_type(bob_received, 'server_offer'))['name'] == 'alice'
+
+        await first.handle_ready('bob', alice)
+        assert (await received_type(bob_received, 'server_userready'))['peername'] == 'alice'
+        assert bob.otherName == 'alice'
+
+        await second.send_candidate_request('alice', {'candidate': 'c1'}, bob)
+        assert (await received_type(alice_received, 'server_candidate'))['candidate'] == {'candidate': 'c1'}
+
+        await first.leave('bob', alice)
+        await received_type(bob_received, 'server_userwanttoleave')
+        assert bob.otherName is None
+
+        await first.backplane.close()
+        await second.backplane.close()
+
+    asyncio.run(scenario())
+
+
+def test_status_update_does_not_bring_back_a_released_user(redis_server):
+    async def scenario():
+        manager = await start_worker()
+        alice, _ = await open_connection(manager)
+        bob, bob_received = await open_connection(manager)
+        await manager.login_user('alice', alice)
+        await manager.login_user('bob', bob)
+
+        await manager.handle_quit('bob', bob)
+        await manager.leave('alice', bob)
+        # a peer released between the status check and the write
+        await manager.update_user_status('bob', 'online')
+        assert await manager.backplane.roster() == {'alice': 'online'}
+
+        bob_received.clear()
+        await manager.login_user('bob', bob)
+        assert (await received_type(bob_received, 'server_login'))['success'] is True
+        await manager.backplane.close()
+
+    asyncio.run(scenario())
+
+
+def test_handlers_keep_answering_while_redis_is_down(redis_server):
+    async def scenario():
+        manager = await start_worker()
+        alice, alice_received = await open_connection(manager)
+        carol, carol_received = await open_connection(manager)
+        await manager.login_user('alice', alice)
+
+        redis_server.connected = False
+        alice_received.clear()
+        await manager.want_to_call('bob', alice)
+        assert (await received_type(alice_received, 'server_nouser'))['success'] is False
+        # uniqueness can't be checked, so nobody new gets in
+        await manager.login_user('carol', carol)
+        assert (await received_type(carol_received, 'server_login'))['success'] is False
+        await manager.handle_quit('alice', alice)
+
+        # the roster entry left by the failed release is dropped once redis is back
+        redis_server.connected = True
+        alice_received.clear()
+        await manager.login_user('alice', alice)
+        assert (await received_type(alice_received, 'server_login'))['success'] is True
+        assert await manager.backplane.roster() == {'alice': 'online'}
+        await manager.backplane.close()
+
+    asyncio.run(scenario())
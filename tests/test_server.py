@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from signaling_server import server
+from signaling_server.manager import (
+    OUTBOUND_QUEUE_SIZE, PONG_FRAME, ConnectionManager, SignalingWebSocket
+)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # fresh manager per test, the handlers look it up on the server module
+    manager = ConnectionManager()
+    monkeypatch.setattr(server, 'manager', manager)
+    return manager
+
+
+@pytest.fixture
+def client(manager):
+    with TestClient(server.app) as client:
+        yield client
+
+
+def receive_until(ws, a_type, match=lambda message: True):
+    while True:
+        message = ws.receive_json()
+        if message['type'] == a_type and match(message):
+            return message
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def login(ws, name):
+    ws.send_json({'type': 'login', 'name': name})
+    assert receive_until(ws, 'server_login')['success'] is True
+
+
+def test_disconnect_removes_user_and_cancels_writer(client, manager):
+    with client.websocket_connect('/ws') as ws:
+        login(ws, 'alice')
+        connection = manager.get_connection('alice')
+        assert connection is not None
+
+    wait_for(lambda: not manager.users)
+    wait_for(lambda: connection.writer_task.done())
+    assert connection.writer_task.cancelled()
+    assert connection.is_open is False
+
+
+def test_slow_client_is_dropped_when_its_queue_overflows():
+    async def scenario():
+        manager = ConnectionManager()
+        sent = []
+        # client that never acknowledges a frame
+        stalled = asyncio.Event()
+
+        async def receive():
+            return {'type': 'websocket.connect'}
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] == 'websocket.send':
+                await stalled.wait()
+
+        connection = SignalingWebSocket({'type': 'websocket', 'path': '/ws', 'headers': []}, receive, send)
+        await manager.connect(connection, receive, send)
+        await manager.login_user('alice', connection)
+        for _ in range(OUTBOUND_QUEUE_SIZE + 2):
+            await manager.send_raw(connection, PONG_FRAME)
+
+        assert connection.is_open is False
+        assert 'alice' not in manager.users
+        for _ in range(100):
+            if sent[-1]['type'] == 'websocket.close':
+                break
+            await asyncio.sleep(0.01)
+        assert sent[-1]['type'] == 'websocket.close'
+        assert sent[-1]['code'] == 1008
+        await asyncio.sleep(0)
+        assert connection.writer_task.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_ready_links_peers_for_candidate_relay(client, manager):
+    with client.websocket_connect('/ws') as a, client.websocket_connect('/ws') as b:
+        login(a, 'alice')
+        login(b, 'bob')
+        a.send_json({'type': 'ready', 'name': 'bob'})
+        assert receive_until(a, 'server_userready')['peername'] == 'bob'
+        assert receive_until(b, 'server_userready')['peername'] == 'alice'
+
+        alice, bob = manager.get_connection('alice'), manager.get_connection('bob')
+        assert alice.peer_ws is bob
+        assert bob.peer_ws is alice
+
+        a.send_json({'type': 'candidate', 'name': 'bob', 'candidate': {'candidate': 'c1'}})
+        assert receive_until(b, 'server_candidate')['candidate'] == {'candidate': 'c1'}
+
+        a.send_json({'type': 'leave', 'name': 'bob'})
+        receive_until(b, 'server_userwanttoleave')
+        wait_for(lambda: alice.peer_ws is None and bob.peer_ws is None)
+
+
+def test_signaling_flow(client, manager):
+    with client.websocket_connect('/ws') as a, client.websocket_connect('/ws') as b:
+        login(a, 'alice')
+        login(b, 'bob')
+        # userlist updates are coalesced, wait for the one carrying both users
+        receive_until(a, 'server_userlist', lambda m: m['name'] == [['alice', 'online'], ['bob', 'online']])
+
+        b.send_json({'type': 'login', 'name': 'alice'})
+        assert receive_until(b, 'server_login')['success'] is False
+
+        a.send_json({'type': 'offer', 'name': 'bob', 'offer': {'sdp': 'offer'}})
+        assert receive_until(b, 'server_offer') == {'type': 'server_offer', 'offer': {'sdp': 'offer'}, 'name': 'alice'}
+        b.send_json({'type': 'answer', 'name': 'alice', 'answer': {'sdp': 'answer'}})
+        assert receive_until(a, 'server_answer') == {'type': 'server_answer', 'answer': {'sdp': 'answer'}}
+
+        a.send_json({'type': 'ready', 'name': 'bob'})
+        receive_until(a, 'server_userready')
+        receive_until(b, 'server_userready')
+        a.send_json({'type': 'want_to_call', 'name': 'bob'})
+        assert receive_until(a, 'server_alreadyinroom')['success'] is True
+
+        a.send_json({'type': 'leave', 'name': 'bob'})
+        receive_until(a, 'server_userwanttoleave')
+        receive_until(b, 'server_userwanttoleave')
+        a.send_json({'type': 'want_to_call', 'name': 'bob'})
+        assert receive_until(a, 'server_alreadyinroom')['success'] is False
+
+        a.send_json({'type': 'want_to_call', 'name': 'carol'})
+        assert receive_until(a, 'server_nouser')['success'] is False
+        a.send_json({'type': 'clientping'})
+        assert receive_until(a, 'server_pong') == {'type': 'server_pong', 'name': 'pong'}
+        a.send_json({'type': 'dance'})
+        assert receive_until(a, 'server_error')['message'] == 'Unrecognized `command`: dance'
+
+        b.send_json({'type': 'quit', 'name': 'bob'})
+        receive_until(a, 'server_userlist', lambda m: m['name'] == [['alice', 'online']])
+        assert list(manager.users) == ['alice']
+
+
+
+def test_quit_socket_no_longer_acts_as_the_user(client, manager):
+    with client.websocket_connect('/ws') as a, client.websocket_connect('/ws') as b:
+        login(a, 'alice')
+        login(b, 'bob')
+        b.send_json({'type': 'quit', 'name': 'bob'})
+        b.send_json({'type': 'ready', 'name': 'alice'})
+        b.send_json({'type': 'leave', 'name': 'alice'})
+        b.send_json({'type': 'clientping'})
+        # frames are handled in order, so the pong comes after ready/leave were processed
+        frames = []
+        while not frames or frames[-1]['type'] != 'server_pong':
+            frames.append(b.receive_json())
+        assert not {'server_userready', 'server_userwanttoleave'} & {f['type'] for f in frames}
+
+        alice = manager.get_connection('alice')
+        assert alice.otherName is None
+        assert alice.peer_ws is None
+        assert manager.users['alice'].status == 'online'
+
+        # the socket can log in again under the same name
+        login(b, 'bob')
+
+@pytest.mark.parametrize('frame', [
+    '', 'not json', '[1, 2]', '"text"',
+    '{"type": null}', '{"type": ["x"]}', '{"type": "login"}', '{"type": "login", "name": ["x"]}',
+])
+def test_malformed_frame_is_answered_with_server_error(client, frame):
+    with client.websocket_connect('/ws') as ws:
+        ws.send_text(frame)
+        assert ws.receive_json() == {'type': 'server_error', 'message': 'Malformed message'}
+        # connection stays usable
+        ws.send_json({'type': 'clientping'})
+        assert ws.receive_json()['type'] == 'server_pong'